@@ -0,0 +1,97 @@
+import threading
+import time
+
+from sqlalchemy import insert
+
+from . import db
+from .models import lock_outbox
+
+
+class PendingInsert:
+    """A single-row insert awaiting commit.
+
+    checks are callables taking the connection that run before the insert,
+    and followups take the connection and the inserted row and run after it.
+    Both run in the batch transaction and may raise to fail just this insert.
+    """
+
+    def __init__(self, table, values, checks=(), followups=()):
+        self.table = table
+        self.values = values
+        self.checks = checks
+        self.followups = followups
+        self.row = None
+        self.error = None
+        self.done = threading.Event()
+
+    def execute(self, conn):
+        for check in self.checks:
+            check(conn)
+        self.row = conn.execute(insert(self.table).values(**self.values).returning(self.table)).one()
+        for followup in self.followups:
+            followup(conn, self.row)
+
+
+class GroupCommitter:
+    """Coalesce single-row inserts from concurrent requests into one transaction.
+
+    The first request to arrive becomes the leader: it waits for
+    GROUP_COMMIT_WINDOW_MS, takes everything queued in the meantime and commits
+    it together. The other requests block until their row has been written.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leading = False
+
+    @property
+    def enabled(self):
+        return bool(self.app.config.get('GROUP_COMMIT_WINDOW_MS'))
+
+    def insert(self, table, values, checks=(), followups=()):
+        """Insert one row and return it once its batch has committed.
+
+        Callers must not hold a pooled connection while they wait, or a burst
+        larger than the pool leaves the leader unable to check one out.
+        """
+        item = PendingInsert(table, values, checks, followups)
+        with self._lock:
+            self._pending.append(item)
+            leader = not self._leading
+            self._leading = True
+
+        if leader:
+            time.sleep(self.app.config['GROUP_COMMIT_WINDOW_MS'] / 1000)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._leading = False
+            self._flush(batch)
+        else:
+            item.done.wait()
+
+        if item.error is not None:
+            raise item.error
+        return item.row
+
+    def _flush(self, batch):
+        # Every transaction takes the outbox lock first, like the routes, before any row lock
+        try:
+            with db.engine.begin() as conn:
+                lock_outbox(conn)
+                for item in batch:
+                    item.execute(conn)
+        except Exception:
+            # One bad row poisons the shared transaction, so replay each row on its own
+            for item in batch:
+                item.row = None
+                try:
+                    with db.engine.begin() as conn:
+                        lock_outbox(conn)
+                        item.execute(conn)
+                except Exception as e:
+                    item.error = e
+        finally:
+            for item in batch:
+                item.done.set()
@@ -0,0 +1,77 @@
+import threading
+
+from sqlalchemy import delete, exists, func, select
+
+from . import db
+from .models import User, Project, ChangeEvent
+
+
+def purge_batch(model, batch_size, *criteria):
+    """Physically delete up to batch_size soft-deleted rows of model and return how many went."""
+    ids = db.session.execute(
+        select(model.id).where(model.deleted_at.is_not(None), *criteria).limit(batch_size),
+        execution_options={'include_deleted': True},
+    ).scalars().all()
+    if ids:
+        db.session.execute(delete(model).where(model.id.in_(ids)), execution_options={'synchronize_session': False})
+    db.session.commit()
+    return len(ids)
+
+
+def purge_change_events(keep_events, batch_size):
+    """Delete all but the newest keep_events outbox rows in small batches and return how many went.
+
+    Consumers that fall more than keep_events behind can no longer sync incrementally.
+    """
+    cutoff = db.session.execute(select(func.max(ChangeEvent.seq) - keep_events)).scalar()
+    purged = 0
+    while cutoff is not None:
+        seqs = db.session.execute(
+            select(ChangeEvent.seq).where(ChangeEvent.seq <= cutoff).order_by(ChangeEvent.seq).limit(batch_size)
+        ).scalars().all()
+        if seqs:
+            db.session.execute(delete(ChangeEvent).where(ChangeEvent.seq.in_(seqs)),
+                               execution_options={'synchronize_session': False})
+        db.session.commit()
+        purged += len(seqs)
+        if len(seqs) < batch_size:
+            break
+    return purged
+
+
+def compact(batch_size=500, keep_events=None):
+    """Purge every soft-deleted project, then user, then outbox rows past retention.
+
+    Each small batch is committed on its own. keep_events=None keeps the whole outbox.
+    """
+    purged = {}
+    # Projects go first, and a user still referenced by any projects row is left for a later
+    # run, so one stray row can never fail the foreign key and roll back a whole batch
+    unreferenced = ~exists().where(Project.user_id == User.id)
+    for model, criteria in ((Project, ()), (User, (unreferenced,))):
+        purged[model.__tablename__] = 0
+        while True:
+            count = purge_batch(model, batch_size, *criteria)
+            purged[model.__tablename__] += count
+            if count < batch_size:
+                break
+    if keep_events is not None:
+        purged[ChangeEvent.__tablename__] = purge_change_events(keep_events, batch_size)
+    return purged
+
+
+def start_compaction_thread(app):
+    """Run compact() every COMPACTION_INTERVAL_SECONDS on a daemon thread."""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(app.config['COMPACTION_INTERVAL_SECONDS']):
+            with app.app_context():
+                try:
+                    compact(app.config['COMPACTION_BATCH_SIZE'], app.config['CHANGES_RETAIN_EVENTS'])
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error compacting soft-deleted rows: {e}")
+
+    threading.Thread(target=run, name='compaction', daemon=True).start()
+    return stop
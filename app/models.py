@@ -1,23 +1,89 @@
 from . import db
-from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy.orm import Session, relationship, with_loader_criteria
+from sqlalchemy import JSON, Column, DateTime, Index, Integer, String, ForeignKey, event, func, select, text
+from sqlalchemy.engine import Connection
 
+LIVE_ROWS = text('deleted_at IS NULL')
 
-class User(db.Model):
+
+class SoftDeleteMixin:
+    """Rows are hidden by setting deleted_at and purged later by app.compaction."""
+    deleted_at = Column(DateTime)
+
+
+class User(SoftDeleteMixin, db.Model):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    email = Column(String(120), unique=True, nullable=False)
+    email = Column(String(120), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # Live projects owned by this user, kept in step by the project routes
+    project_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # Every ORM flush checks and bumps the version, same as the routes' bulk UPDATEs
+    __mapper_args__ = {'version_id_col': version}
+    # Emails only need to be unique among live users, so a deleted address can sign up again
+    __table_args__ = (
+        Index('ix_users_email_live', 'email', unique=True, sqlite_where=LIVE_ROWS, postgresql_where=LIVE_ROWS),
+    )
 
 
-class Project(db.Model):
+class Project(SoftDeleteMixin, db.Model):
     __tablename__ = 'projects'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     description = Column(String)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
 
     owner = relationship('User', back_populates='projects')
 
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (
+        Index('ix_projects_user_id_live', 'user_id', sqlite_where=LIVE_ROWS, postgresql_where=LIVE_ROWS),
+    )
+
+
+class ChangeEvent(db.Model):
+    """Outbox row appended by every write route in its own transaction, read by GET /changes."""
+    __tablename__ = 'change_events'
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String(20), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(20), nullable=False)
+    data = Column(JSON)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+# Arbitrary application-wide key for pg_advisory_xact_lock around outbox appends
+OUTBOX_LOCK_KEY = 7_300_300
+
+
+def lock_outbox(executor):
+    """Take the outbox lock as the first statement of a write transaction, held until commit.
+
+    PostgreSQL hands out change_events.seq on insert, not on commit, so without this a reader
+    could see seq N+1 and move past N before N commits. Taking it before any row lock keeps the
+    lock order the same everywhere, so it cannot deadlock, but it serialises all writes.
+    SQLite already serialises writers, so this is a no-op there.
+    """
+    # Connections know their dialect; a session has to ask its bind
+    dialect = executor.dialect if isinstance(executor, Connection) else executor.get_bind().dialect
+    if dialect.name == 'postgresql':
+        executor.execute(select(func.pg_advisory_xact_lock(OUTBOX_LOCK_KEY)))
+
 
 User.projects = relationship('Project', back_populates='owner', cascade='all, delete-orphan')
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def hide_soft_deleted(execute_state):
+    """Filter soft-deleted rows out of every ORM SELECT unless include_deleted is set."""
+    if (
+        execute_state.is_select
+        and not execute_state.is_column_load
+        and not execute_state.execution_options.get('include_deleted', False)
+    ):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(SoftDeleteMixin, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+        )
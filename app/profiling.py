@@ -0,0 +1,157 @@
+import cProfile
+import hmac
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from flask import g, has_app_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+
+from . import db
+
+PROFILE_HEADER = 'X-Profile'
+
+# Only one cProfile profiler can be active at a time on Python 3.12+, so requests take turns.
+# The holder also owns the DB span listeners, which are attached only while it runs.
+profiler_lock = threading.Lock()
+
+
+def record_span(name, seconds):
+    """Add time to the named span of the request being profiled, if any."""
+    if has_app_context() and g.get('profile_spans') is not None:
+        g.profile_spans[name] += seconds
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider that charges request parsing and response serialization to their spans."""
+
+    def loads(self, s, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().loads(s, **kwargs)
+        finally:
+            record_span('json_parse', time.perf_counter() - start)
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            record_span('serialize', time.perf_counter() - start)
+
+
+def start_db_span(conn, cursor, statement, parameters, context, executemany):
+    context.profile_started = time.perf_counter()
+
+
+def end_db_span(conn, cursor, statement, parameters, context, executemany):
+    # Statements already running when the listeners were attached have no start time
+    started = getattr(context, 'profile_started', None)
+    if started is not None:
+        record_span('db', time.perf_counter() - started)
+
+
+def attach_db_spans(engine):
+    event.listen(engine, 'before_cursor_execute', start_db_span)
+    event.listen(engine, 'after_cursor_execute', end_db_span)
+
+
+def detach_db_spans(engine):
+    event.remove(engine, 'before_cursor_execute', start_db_span)
+    event.remove(engine, 'after_cursor_execute', end_db_span)
+
+
+def requested_by_header(app):
+    """The X-Profile header only counts when it carries the configured PROFILING_SECRET."""
+    secret = app.config['PROFILING_SECRET']
+    header = request.headers.get(PROFILE_HEADER)
+    return bool(secret) and header is not None and hmac.compare_digest(header, secret)
+
+
+def profile_count(app):
+    try:
+        return sum(name.endswith('.prof') for name in os.listdir(app.config['PROFILING_DIR']))
+    except FileNotFoundError:
+        return 0
+
+
+def should_profile(app):
+    if not app.config['PROFILING_ENABLED']:
+        return False
+    if not (requested_by_header(app) or random.random() < app.config['PROFILING_SAMPLE_RATE']):
+        return False
+    return profile_count(app) < app.config['PROFILING_MAX_PROFILES']
+
+
+def write_profile(app, profiler, spans, elapsed):
+    """Write cProfile stats and a folded-stack span file, returning their shared name."""
+    os.makedirs(app.config['PROFILING_DIR'], exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unknown'}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(app.config['PROFILING_DIR'], profile_id)
+
+    profiler.dump_stats(f'{path}.prof')
+
+    # One "stack value" line per span in microseconds, as read by flamegraph.pl and speedscope
+    root = f'{request.method} {request.url_rule or request.path}'
+    spans['other'] = max(elapsed - sum(spans.values()), 0.0)
+    with open(f'{path}.folded', 'w') as folded:
+        for name, seconds in spans.items():
+            folded.write(f'{root};{name} {round(seconds * 1_000_000)}\n')
+    return profile_id
+
+
+def init_profiling(app):
+    """Profile sampled requests when PROFILING_ENABLED is set.
+
+    A request is profiled when it carries PROFILING_SECRET in the X-Profile
+    header or wins the PROFILING_SAMPLE_RATE draw, no other request is being
+    profiled, and PROFILING_DIR holds fewer than PROFILING_MAX_PROFILES
+    profiles. The response names the files it wrote in X-Profile-Id.
+    """
+    app.json = TimedJSONProvider(app)
+
+    def end_profile():
+        """Stop this request's profiler, detach the DB listeners and let the next request profile."""
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        detach_db_spans(g.pop('profile_engine'))
+        profiler_lock.release()
+
+    @app.before_request
+    def start_profile():
+        if not should_profile(app) or not profiler_lock.acquire(blocking=False):
+            return
+        g.profile_engine = db.engine
+        attach_db_spans(g.profile_engine)
+        g.profile_spans = defaultdict(float)
+        g.profile_started = time.perf_counter()
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        profiler = g.get('profiler')
+        if profiler is None:
+            return response
+        profiler.disable()
+        spans = g.pop('profile_spans')
+        elapsed = time.perf_counter() - g.pop('profile_started')
+        # Write while still holding the lock so PROFILING_MAX_PROFILES is never overshot
+        try:
+            response.headers['X-Profile-Id'] = write_profile(app, profiler, spans, elapsed)
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+        finally:
+            end_profile()
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # after_request is skipped if the response could not be built; never keep the lock
+        end_profile()
@@ -1,7 +1,11 @@
-from flask import Blueprint, jsonify, request
+import json
+import time
+
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import func, insert, literal, select, update
 from sqlalchemy.exc import IntegrityError
-from .models import db, User, Project
-from helper.constants import INTERNAL_SERVER_ERROR, USER_NOT_FOUND
+from .models import db, User, Project, ChangeEvent, lock_outbox
+from helper.constants import INTERNAL_SERVER_ERROR, USER_NOT_FOUND, VERSION_MISMATCH
 
 main = Blueprint('main', __name__)
 
@@ -17,6 +21,48 @@ def find_project_by_id(project_id):
     return next((project for project in projects if project['id'] == project_id), None)
 
 
+def get_live_user(user_id):
+    """Look up a user by id, skipping soft-deleted rows even if the identity map still holds them."""
+    return User.query.filter_by(id=user_id, deleted_at=None).first()
+
+
+def group_committer():
+    """Return the app's group committer when GROUP_COMMIT_WINDOW_MS enables it."""
+    committer = current_app.extensions.get('group_commit')
+    return committer if committer is not None and committer.enabled else None
+
+
+def append_change(executor, entity, entity_id, op, data=None):
+    """Append an outbox row in the same transaction as the change it records.
+
+    The transaction must have started with lock_outbox, before taking any row locks.
+    """
+    executor.execute(insert(ChangeEvent.__table__).values(entity=entity, entity_id=entity_id, op=op, data=data))
+
+
+def serialize_change(event):
+    return {
+        'seq': event.seq,
+        'entity': event.entity,
+        'entity_id': event.entity_id,
+        'op': event.op,
+        'data': event.data,
+        'created_at': event.created_at.isoformat(),
+    }
+
+
+def changes_since(since, limit):
+    """Return up to limit serialized change events after since, in sequence order."""
+    events = db.session.execute(
+        select(ChangeEvent).where(ChangeEvent.seq > since).order_by(ChangeEvent.seq).limit(limit)
+    ).scalars().all()
+    # Serialize before the rollback expires the rows, or each one is reloaded with its own SELECT
+    changes = [serialize_change(event) for event in events]
+    # End the read transaction so the next poll sees rows committed meanwhile
+    db.session.rollback()
+    return changes
+
+
 @main.route('/')
 def home():
     return jsonify({'message': 'Welcome to the Flask App'})
@@ -29,15 +75,25 @@ def create_user():
         if 'name' not in data or 'email' not in data:
             return jsonify({'error': 'Missing name or email'}), 400
 
-        user = User(name=data['name'], email=data['email'])
-
-        db.session.add(user)
-        db.session.commit()
-
-        return jsonify({"id": user.id, "message": 'User created'}), 201
+        values = {'name': data['name'], 'email': data['email']}
+        committer = group_committer()
+        if committer:
+            user = committer.insert(User.__table__, values,
+                                    followups=(lambda conn, row: append_change(conn, 'user', row.id, 'created', values),))
+        else:
+            lock_outbox(db.session)
+            user = User(name=data['name'], email=data['email'])
+            db.session.add(user)
+            db.session.flush()
+            append_change(db.session, 'user', user.id, 'created', values)
+            db.session.commit()
+
+        response = jsonify({"id": user.id, "message": 'User created'})
+        response.set_etag(str(user.version))
+        return response, 201
     except IntegrityError as e:
         db.session.rollback()  # Rollback the transaction to avoid lingering locks
-        if "UNIQUE constraint failed" in str(e):
+        if is_duplicate_email(e):
             return jsonify({'message': 'User with this email already exists'}), 400
         return jsonify({'error': 'Database error occurred'}), 500
     except Exception as e:
@@ -52,34 +108,164 @@ def get_users_list():
     return jsonify([{'id': user.id, 'name': user.name, 'email': user.email} for user in users])
 
 
-@main.route('/users/<int:user_id>', methods=['PUT'])
-def update_user(user_id):
-    try:
-        user = User.query.get(user_id)
-    except Exception as _:
-        return jsonify({'message': USER_NOT_FOUND}), 404
+def is_duplicate_email(error):
+    """Tell a unique-email violation apart from other integrity errors on SQLite and PostgreSQL."""
+    return "UNIQUE constraint failed" in str(error) or getattr(error.orig, 'pgcode', None) == '23505'
+
+
+def user_columns(data, keys):
+    """Pick the writable keys present in the body, rejecting values that are not strings."""
+    if not isinstance(data, dict):
+        return None, 'Request body must be a JSON object'
+    values = {key: data[key] for key in keys if key in data}
+    for key, value in values.items():
+        if not isinstance(value, str):
+            return None, f"'{key}' must be a string"
+    if values.get('email') == '':
+        return None, "'email' must not be empty"
+    return values, None
+
+
+def expected_versions():
+    """Return the versions listed in the If-Match header, or None when there is no precondition.
+
+    Any listed version may match. Tags that are not version numbers can never match.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return {int(tag) for tag in request.if_match if tag.isdigit()}
+
+
+def write_user_columns(user_id, values):
+    """Write only the given columns with a single UPDATE, honouring If-Match."""
+    versions = expected_versions()
+    if versions == set():
+        return jsonify({'message': VERSION_MISMATCH}), 412
 
-    updated_data = request.json
-    user.name = updated_data.get("name", user.name)
+    stmt = update(User).where(User.id == user_id, User.deleted_at.is_(None))
+    if versions is not None:
+        stmt = stmt.where(User.version.in_(versions))
+    stmt = stmt.values(version=User.version + 1, **values).returning(User.version)
 
     try:
+        lock_outbox(db.session)
+        new_version = db.session.execute(stmt, execution_options={'synchronize_session': False}).scalar()
+        if new_version is None:
+            db.session.rollback()
+            # Only pay for the existence check when the fast path missed
+            if versions is not None and get_live_user(user_id) is not None:
+                return jsonify({'message': VERSION_MISMATCH}), 412
+            return jsonify({'message': USER_NOT_FOUND}), 404
+        append_change(db.session, 'user', user_id, 'updated', dict(values, version=new_version))
         db.session.commit()
-        return jsonify({"message": "User updated"}), 200
+    except IntegrityError as e:
+        db.session.rollback()
+        if is_duplicate_email(e):
+            return jsonify({'message': 'User with this email already exists'}), 400
+        print(f"Error updating user: {e}")
+        return jsonify({'message': 'Error updating user'}), 500
     except Exception as e:
         db.session.rollback()
         print(f"Error updating user: {e}")
         return jsonify({'message': 'Error updating user'}), 500
 
+    response = jsonify({"message": "User updated"})
+    response.set_etag(str(new_version))
+    return response, 200
+
+
+@main.route('/users/stats', methods=['GET'])
+def get_users_stats():
+    """Per-user project counts and totals, read from the maintained users.project_count."""
+    try:
+        rows = db.session.execute(select(User.id, User.name, User.project_count).order_by(User.id)).all()
+        return jsonify({
+            'total_users': len(rows),
+            'total_projects': sum(row.project_count for row in rows),
+            'users': [{'id': row.id, 'name': row.name, 'project_count': row.project_count} for row in rows],
+        }), 200
+    except Exception:
+        return jsonify({'error': INTERNAL_SERVER_ERROR}), 500
+
+
+@main.route('/users/<int:user_id>', methods=['GET'])
+def get_user(user_id):
+    """Return one live user with its version as the ETag for a later If-Match."""
+    user = get_live_user(user_id)
+    if not user:
+        return jsonify({'message': USER_NOT_FOUND}), 404
+
+    response = jsonify({'id': user.id, 'name': user.name, 'email': user.email, 'version': user.version})
+    response.set_etag(str(user.version))
+    return response.make_conditional(request)
+
+
+@main.route('/users/<int:user_id>', methods=['PUT'])
+def update_user(user_id):
+    values, error = user_columns(request.json, ('name',))
+    if error:
+        return jsonify({'error': error}), 400
+    if values:
+        return write_user_columns(user_id, values)
+
+    # PUT without a name has always been a successful no-op; keep it that way without writing
+    user = get_live_user(user_id)
+    if not user:
+        return jsonify({'message': USER_NOT_FOUND}), 404
+    versions = expected_versions()
+    if versions is not None and user.version not in versions:
+        return jsonify({'message': VERSION_MISMATCH}), 412
+    response = jsonify({"message": "User updated"})
+    response.set_etag(str(user.version))
+    return response, 200
+
+
+@main.route('/users/<int:user_id>', methods=['PATCH'])
+def patch_user(user_id):
+    values, error = user_columns(request.get_json(silent=True) or {}, ('name', 'email'))
+    if error:
+        return jsonify({'error': error}), 400
+    if not values:
+        return jsonify({'error': 'No fields to update'}), 400
+    return write_user_columns(user_id, values)
+
 
 @main.route('/users/<int:user_id>', methods=['DELETE'])
 def delete_user(user_id):
+    """Soft-delete a user and their projects; app.compaction purges them later."""
     try:
-        user = User.query.get(user_id)
-    except Exception as _:
-        return jsonify({'message': 'User not found'}), 404
+        lock_outbox(db.session)
+        deleted = db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.deleted_at.is_(None))
+            .values(deleted_at=func.now(), version=User.version + 1, project_count=0),
+            execution_options={'synchronize_session': False},
+        ).rowcount
+        if not deleted:
+            db.session.rollback()
+            return jsonify({'message': 'User not found'}), 404
+
+        append_change(db.session, 'user', user_id, 'deleted')
+        db.session.execute(
+            insert(ChangeEvent.__table__).from_select(
+                ['entity', 'entity_id', 'op'],
+                select(literal('project'), Project.id, literal('deleted'))
+                .where(Project.user_id == user_id, Project.deleted_at.is_(None))
+                .order_by(Project.id),
+            )
+        )
+        db.session.execute(
+            update(Project)
+            .where(Project.user_id == user_id, Project.deleted_at.is_(None))
+            .values(deleted_at=func.now(), version=Project.version + 1),
+            execution_options={'synchronize_session': False},
+        )
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error deleting user: {e}")
+        return jsonify({'error': INTERNAL_SERVER_ERROR}), 500
 
-    db.session.delete(user)
-    db.session.commit()
     return jsonify({"message": "User deleted"}), 200
 
 
@@ -88,17 +274,47 @@ def create_project():
     try:
         data = request.get_json()
         user_id = data.get('user_id')
-        user = User.query.get(user_id)
+        committer = group_committer()
 
-        if not user:
+        # In group mode count_on_live_owner checks the owner inside the batch instead, so this
+        # request never holds a pooled connection while it waits for the batch leader
+        if not committer and not get_live_user(user_id):
             return jsonify({'error': USER_NOT_FOUND}), 404  # Unauthorized user
 
-        project = Project(name=data['name'], description=data['description'], user_id=user_id)
-        db.session.add(project)
-        db.session.commit()
+        # Bumping the counter only on a live owner also row-locks it until commit, so a concurrent
+        # DELETE /users/<id> either wins before this check or soft-deletes this project after it.
+        # The counter is not user-editable, so it leaves the optimistic-concurrency version alone.
+        count_project = (
+            update(User)
+            .where(User.id == user_id, User.deleted_at.is_(None))
+            .values(project_count=User.project_count + 1)
+        )
+
+        def count_on_live_owner(executor):
+            if not executor.execute(count_project, execution_options={'synchronize_session': False}).rowcount:
+                raise LookupError(USER_NOT_FOUND)
+
+        values = {'name': data['name'], 'description': data['description'], 'user_id': user_id}
+        if committer:
+            project = committer.insert(
+                Project.__table__, values,
+                checks=(count_on_live_owner,),
+                followups=(lambda conn, row: append_change(conn, 'project', row.id, 'created', values),),
+            )
+        else:
+            lock_outbox(db.session)
+            project = Project(name=data['name'], description=data['description'], user_id=user_id)
+            db.session.add(project)
+            db.session.flush()
+            count_on_live_owner(db.session)
+            append_change(db.session, 'project', project.id, 'created', values)
+            db.session.commit()
 
         return jsonify({'message': 'Project created', 'project_id': project.id}), 201
 
+    except LookupError:
+        db.session.rollback()
+        return jsonify({'error': USER_NOT_FOUND}), 404
     except Exception as e:
         db.session.rollback()
         print(f"Error creating project: {e}")
@@ -112,7 +328,7 @@ def get_projects_by_user(user_id):
         if not current_user_id:
             return jsonify({'error': 'Unauthorized'}), 403  # Unauthorized access
 
-        current_user = User.query.get(current_user_id)
+        current_user = get_live_user(current_user_id)
         if not current_user:
             return jsonify({'error': USER_NOT_FOUND}), 403
 
@@ -128,14 +344,38 @@ def get_projects_by_user(user_id):
 
 @main.route('/projects/<int:project_id>', methods=['DELETE'])
 def delete_project(project_id):
-    """Delete a project by ID."""
+    """Soft-delete a project by ID."""
     try:
-        project = Project.query.get(project_id)
-    except Exception as _:
-        return jsonify({'message': 'Project not found'}), 404
+        lock_outbox(db.session)
+        # Lock the owner before the project, the same order as delete_user, so the two cannot deadlock
+        live_owner_id = (
+            select(Project.user_id)
+            .where(Project.id == project_id, Project.deleted_at.is_(None))
+            .scalar_subquery()
+        )
+        counted = db.session.execute(
+            update(User).where(User.id == live_owner_id).values(project_count=User.project_count - 1),
+            execution_options={'synchronize_session': False},
+        ).rowcount
+        # A concurrent delete of the same project can pass the first check, so the project
+        # UPDATE decides; rolling back also undoes the decrement
+        deleted = counted and db.session.execute(
+            update(Project)
+            .where(Project.id == project_id, Project.deleted_at.is_(None))
+            .values(deleted_at=func.now(), version=Project.version + 1),
+            execution_options={'synchronize_session': False},
+        ).rowcount
+        if not deleted:
+            db.session.rollback()
+            return jsonify({'message': 'Project not found'}), 404
+
+        append_change(db.session, 'project', project_id, 'deleted')
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error deleting project: {e}")
+        return jsonify({'error': INTERNAL_SERVER_ERROR}), 500
 
-    db.session.delete(project)
-    db.session.commit()
     return jsonify({'message': 'Project deleted'}), 200
 
 
@@ -148,3 +388,48 @@ def get_users():
     except Exception:
         # Catch any exception and return a 500 error
         return jsonify({'error': 'Internal Server Error'}), 500
+
+
+@main.route('/changes', methods=['GET'])
+def get_changes():
+    """Feed of outbox events after ?since=<seq>, as JSON long-poll or Server-Sent Events.
+
+    ?wait=<seconds> holds a JSON request open until an event arrives; an SSE
+    stream stays open that long and resumes from Last-Event-ID on reconnect.
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+        streaming = request.accept_mimetypes.best == 'text/event-stream'
+        max_wait = current_app.config['CHANGES_MAX_WAIT_SECONDS']
+        wait = min(float(request.args.get('wait', max_wait if streaming else 0)), max_wait)
+    except ValueError:
+        return jsonify({'error': 'since, limit and wait must be numbers'}), 400
+
+    poll_interval = current_app.config['CHANGES_POLL_INTERVAL_SECONDS']
+    deadline = time.monotonic() + wait
+
+    if streaming:
+        def stream(since):
+            while True:
+                for change in changes_since(since, limit):
+                    since = change['seq']
+                    yield f"id: {change['seq']}\nevent: {change['op']}\ndata: {json.dumps(change)}\n\n"
+                if time.monotonic() >= deadline:
+                    return
+                time.sleep(poll_interval)
+
+        return Response(stream_with_context(stream(since)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    try:
+        events = changes_since(since, limit)
+        while not events and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            events = changes_since(since, limit)
+        return jsonify({
+            'events': events,
+            'next': events[-1]['seq'] if events else since,
+        }), 200
+    except Exception:
+        return jsonify({'error': INTERNAL_SERVER_ERROR}), 500
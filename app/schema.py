@@ -0,0 +1,64 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from . import db
+
+BACKFILL_PROJECT_COUNTS = text(
+    'UPDATE users SET project_count = '
+    '(SELECT count(*) FROM projects WHERE projects.user_id = users.id AND projects.deleted_at IS NULL)'
+)
+
+# SQLite does not reflect unnamed inline UNIQUE constraints; they show up as 'u' autoindexes
+SQLITE_INLINE_UNIQUE_EMAIL = text(
+    "SELECT 1 FROM pragma_index_list('users') AS il "
+    "WHERE il.origin = 'u' AND (SELECT group_concat(name) FROM pragma_index_info(il.name)) = 'email'"
+)
+
+
+def upgrade_schema():
+    """Bring a database created by an older create_all up to the current models.
+
+    Creates missing tables and indexes, adds missing columns using their
+    server defaults, and drops the old table-wide unique constraint on
+    users.email that the live-rows index replaces. Safe to run repeatedly.
+
+    SQLite cannot drop a constraint without rebuilding the table, which this
+    does not do: an upgraded SQLite database keeps its inline UNIQUE(email),
+    so a deleted user's email cannot be registered again there. The returned
+    changes say so when that applies.
+    """
+    engine = db.engine
+    db.create_all()
+    inspector = inspect(engine)
+    changes = []
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN '
+                                      f'{CreateColumn(column).compile(dialect=engine.dialect)}'))
+                    changes.append(f'added {table.name}.{column.name}')
+
+        if engine.dialect.name == 'sqlite':
+            if conn.execute(SQLITE_INLINE_UNIQUE_EMAIL).first():
+                changes.append("kept UNIQUE(email) on users: unsupported on SQLite, "
+                               "deleted users' emails cannot be reused")
+        else:
+            for constraint in inspector.get_unique_constraints('users'):
+                if constraint['column_names'] == ['email']:
+                    conn.execute(text(f'ALTER TABLE users DROP CONSTRAINT {constraint["name"]}'))
+                    changes.append(f'dropped {constraint["name"]}')
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+    return changes
+
+
+def backfill_project_counts():
+    """Recompute users.project_count from the live projects and return how many users were updated."""
+    with db.engine.begin() as conn:
+        return conn.execute(BACKFILL_PROJECT_COUNTS).rowcount
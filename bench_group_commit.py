@@ -0,0 +1,56 @@
+"""Compare POST /users throughput with per-request commits and with group commit.
+
+Usage: python bench_group_commit.py [threads] [requests_per_thread] [window_ms]
+
+Runs against a throwaway SQLite file so every commit pays for a real fsync.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from app import create_app, db
+
+
+def run(window_ms, threads, per_thread):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app = create_app(database_uri=f'sqlite:///{path}')
+    app.config['GROUP_COMMIT_WINDOW_MS'] = window_ms
+    with app.app_context():
+        db.create_all()
+
+    created = [0] * threads
+
+    def worker(offset):
+        client = app.test_client()
+        for i in range(per_thread):
+            response = client.post('/users', json={'name': 'bench', 'email': f'{window_ms}-{offset}-{i}@example.com'})
+            # Failed or locked-database requests are not throughput
+            created[offset] += response.status_code == 201
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        db.engine.dispose()
+    os.remove(path)
+    failed = threads * per_thread - sum(created)
+    return sum(created) / elapsed, failed
+
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    window_ms = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    baseline, baseline_failed = run(0, threads, per_thread)
+    grouped, grouped_failed = run(window_ms, threads, per_thread)
+    print(f'per-request commit: {baseline:8.1f} created/s ({baseline_failed} failed)')
+    print(f'group commit ({window_ms} ms): {grouped:8.1f} created/s ({grouped_failed} failed)')
@@ -1,2 +1,3 @@
 INTERNAL_SERVER_ERROR = 'Internal Server Error'
 USER_NOT_FOUND = 'User not found'
+VERSION_MISMATCH = 'User was modified by another request'
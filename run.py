@@ -1,6 +1,12 @@
+import os
+
 from app import create_app
+from app.compaction import start_compaction_thread
 
 app = create_app()
 
 if __name__ == '__main__':
+    # Only the server process compacts, and under the debug reloader only its serving child
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_compaction_thread(app)
     app.run(debug=True)
@@ -1,6 +1,13 @@
+import threading
+import time
+from unittest.mock import patch
 import pytest
-from app.models import User, Project
-from app import db
+from flask import g
+from sqlalchemy import event, text
+from app.models import User, Project, ChangeEvent
+from app import create_app, db
+from app.compaction import compact
+from app.profiling import end_db_span, profiler_lock, start_db_span
 
 
 class TestUserIntegrationTest:
@@ -80,6 +87,113 @@ class TestUserIntegrationTest:
         assert response.status_code == 200
         assert response.json == {'message': 'User updated'}
 
+    def test_update_user_with_matching_version(self):
+        """Test updating a user with an If-Match header naming the current version."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+        etag = create_response.headers['ETag']
+
+        response = self.client.put(f'/users/{user_id}', json={"name": "John Updated"}, headers={'If-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] == '"2"'
+        assert db.session.get(User, user_id).name == "John Updated"
+
+    def test_update_user_with_stale_version(self):
+        """Test that a stale If-Match header is rejected without overwriting the user."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+        etag = create_response.headers['ETag']
+        self.client.put(f'/users/{user_id}', json={"name": "First Writer"}, headers={'If-Match': etag})
+
+        response = self.client.put(f'/users/{user_id}', json={"name": "Second Writer"}, headers={'If-Match': etag})
+        assert response.status_code == 412
+        assert response.json == {'message': 'User was modified by another request'}
+        db.session.expire_all()
+        assert db.session.get(User, user_id).name == "First Writer"
+
+    def test_update_missing_user(self):
+        """Test updating a user that does not exist."""
+        response = self.client.put('/users/999', json={"name": "Nobody"}, headers={'If-Match': '"1"'})
+        assert response.status_code == 404
+        assert response.json == {'message': 'User not found'}
+
+    def test_patch_user_writes_only_given_fields(self):
+        """Test that PATCH leaves fields absent from the body untouched."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+
+        response = self.client.patch(f'/users/{user_id}', json={"email": "john.new@example.com"})
+        assert response.status_code == 200
+        db.session.expire_all()
+        user = db.session.get(User, user_id)
+        assert user.name == "John Doe"
+        assert user.email == "john.new@example.com"
+
+    def test_patch_user_without_fields(self):
+        """Test that PATCH with nothing to write is rejected."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        response = self.client.patch(f"/users/{create_response.json['id']}", json={})
+        assert response.status_code == 400
+        assert response.json == {'error': 'No fields to update'}
+
+    def test_update_user_without_fields(self):
+        """Test that a PUT with nothing to write is still a 200 but does not bump the version."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+
+        response = self.client.put(f'/users/{user_id}', json={"email": "ignored@example.com"})
+        assert response.status_code == 200
+        assert response.json == {'message': 'User updated'}
+        assert response.headers['ETag'] == '"1"'
+        assert self.client.get(f'/users/{user_id}').json['version'] == 1
+
+    def test_update_user_requires_json(self):
+        """Test that PUT keeps rejecting non-JSON bodies as an unsupported media type."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        response = self.client.put(f"/users/{create_response.json['id']}", data="name=John")
+        assert response.status_code == 415
+
+    def test_get_user_returns_version_etag(self):
+        """Test that any client can read the current version to use in If-Match."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+        self.client.patch(f'/users/{user_id}', json={"name": "John Updated"})
+
+        response = self.client.get(f'/users/{user_id}')
+        assert response.status_code == 200
+        assert response.json == {'id': user_id, 'name': 'John Updated', 'email': 'john.doe@example.com', 'version': 2}
+        assert response.headers['ETag'] == '"2"'
+        assert self.client.get(f'/users/{user_id}', headers={'If-None-Match': '"2"'}).status_code == 304
+        assert self.client.get('/users/999').status_code == 404
+
+    def test_update_user_with_several_if_match_tags(self):
+        """Test that the update goes through when any listed version is current."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+
+        response = self.client.put(f'/users/{user_id}', json={"name": "John"}, headers={'If-Match': '"7", "1"'})
+        assert response.status_code == 200
+        response = self.client.put(f'/users/{user_id}', json={"name": "John"}, headers={'If-Match': '"2", "9"'})
+        assert response.status_code == 200
+
+        response = self.client.put(f'/users/{user_id}', json={"name": "John"}, headers={'If-Match': '"7", "8"'})
+        assert response.status_code == 412
+
+    def test_patch_user_rejects_null_email(self):
+        """Test that a null email is a validation error rather than a duplicate."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        response = self.client.patch(f"/users/{create_response.json['id']}", json={"email": None})
+        assert response.status_code == 400
+        assert response.json == {'error': "'email' must be a string"}
+
+    def test_patch_user_duplicate_email(self):
+        """Test that PATCH to an email another user holds is reported as a duplicate."""
+        self.client.post('/users', json={"name": "Jane Doe", "email": "jane.doe@example.com"})
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        response = self.client.patch(f"/users/{create_response.json['id']}", json={"email": "jane.doe@example.com"})
+        assert response.status_code == 400
+        assert response.json == {'message': 'User with this email already exists'}
+
     def test_delete_user(self):
         """Test deleting an existing user."""
         user_data = {"name": "John Doe", "email": "john.doe@example.com"}
@@ -90,6 +204,26 @@ class TestUserIntegrationTest:
         assert delete_response.status_code == 200
         assert delete_response.json == {'message': 'User deleted'}
 
+    def test_deleted_user_is_hidden(self):
+        """Test that a soft-deleted user disappears from reads but keeps its row."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        user_id = create_response.json['id']
+        self.client.delete(f'/users/{user_id}')
+
+        assert self.client.get('/users/list').json == []
+        assert self.client.get('/v2/users').json == []
+        assert self.client.delete(f'/users/{user_id}').status_code == 404
+        assert self.client.put(f'/users/{user_id}', json={"name": "Ghost"}).status_code == 404
+        assert User.query.execution_options(include_deleted=True).filter_by(id=user_id).count() == 1
+
+    def test_deleted_user_email_can_be_reused(self):
+        """Test that only live users hold on to their email address."""
+        create_response = self.client.post('/users', json={"name": "John Doe", "email": "john.doe@example.com"})
+        self.client.delete(f"/users/{create_response.json['id']}")
+
+        response = self.client.post('/users', json={"name": "John Again", "email": "john.doe@example.com"})
+        assert response.status_code == 201
+
 
 class TestProjectIntegrationTest:
     @pytest.fixture(autouse=True)
@@ -139,3 +273,391 @@ class TestProjectIntegrationTest:
         response = self.client.get(f'/projects/{user1.id}', query_string={"current_user_id": user2.id})
         assert response.status_code == 403
         assert response.json == {'error': 'Forbidden: You can only access your projects'}
+
+    def test_deleted_project_is_hidden(self):
+        """Test that a soft-deleted project is no longer listed for its owner."""
+        user = self.add_user(name="Alice", email="alice@example.com")
+        project = self.add_project(name="Project A", description="Description A", user_id=user.id)
+        self.client.delete(f'/projects/{project.id}')
+
+        response = self.client.get(f'/projects/{user.id}', query_string={"current_user_id": user.id})
+        assert response.status_code == 200
+        assert response.json == []
+        assert self.client.delete(f'/projects/{project.id}').status_code == 404
+
+    def test_deleted_user_cannot_create_projects(self):
+        """Test that projects cannot be attached to a soft-deleted user."""
+        user = self.add_user(name="Alice", email="alice@example.com")
+        self.client.delete(f'/users/{user.id}')
+
+        project_data = {"name": "Project", "description": "Desc", "user_id": user.id}
+        response = self.client.post('/projects', json=project_data)
+        assert response.status_code == 404
+
+    def test_compaction_purges_deleted_rows_in_batches(self):
+        """Test that compaction removes soft-deleted users and their projects."""
+        keep = self.add_user(name="Keep", email="keep@example.com")
+        self.add_project(name="Kept", description="Desc", user_id=keep.id)
+        for i in range(3):
+            user = self.add_user(name=f"Gone {i}", email=f"gone{i}@example.com")
+            self.add_project(name=f"Gone {i}", description="Desc", user_id=user.id)
+            self.client.delete(f'/users/{user.id}')
+
+        assert compact(batch_size=2) == {'projects': 3, 'users': 3}
+        db.session.expunge_all()  # Purged ids can be reused by SQLite
+
+        assert User.query.execution_options(include_deleted=True).count() == 1
+        assert Project.query.execution_options(include_deleted=True).count() == 1
+
+    def test_create_project_loses_race_with_owner_delete(self):
+        """Test that a project is refused when its owner is deleted after the liveness check."""
+        user = self.add_user(name="Alice", email="alice@example.com")
+        self.client.delete(f'/users/{user.id}')
+
+        project_data = {"name": "Project", "description": "Desc", "user_id": user.id}
+        with patch('app.routes.get_live_user', return_value=user):
+            response = self.client.post('/projects', json=project_data)
+        assert response.status_code == 404
+        assert Project.query.execution_options(include_deleted=True).count() == 0
+
+    def test_compaction_skips_users_still_referenced(self):
+        """Test that a deleted user with a stray live project is left alone instead of failing the batch."""
+        db.session.expunge_all()  # Earlier purges leave stale identities for reused ids
+        stray_owner = self.add_user(name="Stray", email="stray@example.com")
+        gone = self.add_user(name="Gone", email="gone@example.com")
+        self.client.delete(f'/users/{stray_owner.id}')
+        self.client.delete(f'/users/{gone.id}')
+        self.add_project(name="Stray", description="Desc", user_id=stray_owner.id)
+
+        assert compact(batch_size=1) == {'projects': 0, 'users': 1}
+        db.session.expunge_all()  # Purged ids can be reused by SQLite
+        assert User.query.execution_options(include_deleted=True).count() == 1
+
+    def test_users_stats_tracks_project_counts(self):
+        """Test that /users/stats follows project creation and deletion."""
+        alice = self.add_user(name="Alice", email="alice@example.com")
+        bob = self.add_user(name="Bob", email="bob@example.com")
+        for name in ("One", "Two"):
+            self.client.post('/projects', json={"name": name, "description": "Desc", "user_id": alice.id})
+        project_id = self.client.post('/projects', json={"name": "Three", "description": "Desc",
+                                                         "user_id": bob.id}).json['project_id']
+        self.client.delete(f'/projects/{project_id}')
+
+        response = self.client.get('/users/stats')
+        assert response.status_code == 200
+        assert response.json == {
+            'total_users': 2,
+            'total_projects': 2,
+            'users': [
+                {'id': alice.id, 'name': 'Alice', 'project_count': 2},
+                {'id': bob.id, 'name': 'Bob', 'project_count': 0},
+            ],
+        }
+
+    def test_users_stats_skips_deleted_users(self):
+        """Test that a deleted user's projects no longer count towards the totals."""
+        user = self.add_user(name="Alice", email="alice@example.com")
+        self.client.post('/projects', json={"name": "One", "description": "Desc", "user_id": user.id})
+        self.client.delete(f'/users/{user.id}')
+
+        response = self.client.get('/users/stats')
+        assert response.json == {'total_users': 0, 'total_projects': 0, 'users': []}
+
+
+class TestGroupCommitIntegrationTest:
+    @pytest.fixture(autouse=True)
+    def setup_and_teardown(self, app, client):
+        """Enable group commit for the duration of each test."""
+        self.app = app
+        self.client = client
+        User.query.delete()
+        Project.query.delete()
+        db.session.commit()
+        app.config['GROUP_COMMIT_WINDOW_MS'] = 20
+        yield
+        app.config['GROUP_COMMIT_WINDOW_MS'] = 0
+        User.query.delete()
+        Project.query.delete()
+        db.session.commit()
+
+    def post_concurrently(self, payloads):
+        """POST every payload to /users from its own thread and return the responses."""
+        responses = [None] * len(payloads)
+
+        def post(index, payload):
+            with self.app.test_client() as client:
+                responses[index] = client.post('/users', json=payload)
+
+        threads = [threading.Thread(target=post, args=(i, payload)) for i, payload in enumerate(payloads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_create_user_group_commit(self):
+        """Test that a single request is committed on its own once the window expires."""
+        response = self.client.post('/users', json={"name": "Solo", "email": "solo@example.com"})
+        assert response.status_code == 201
+        assert db.session.get(User, response.json['id']).email == "solo@example.com"
+
+    def test_concurrent_creates_get_their_own_ids(self):
+        """Test that coalesced inserts each get a distinct id."""
+        payloads = [{"name": f"User {i}", "email": f"user{i}@example.com"} for i in range(8)]
+        responses = self.post_concurrently(payloads)
+
+        assert [response.status_code for response in responses] == [201] * 8
+        assert len({response.json['id'] for response in responses}) == 8
+        assert User.query.count() == 8
+
+    def test_concurrent_duplicate_only_fails_its_own_request(self):
+        """Test that one bad row in a batch does not fail the rest of it."""
+        payloads = [
+            {"name": "First", "email": "same@example.com"},
+            {"name": "Second", "email": "same@example.com"},
+            {"name": "Other", "email": "other@example.com"},
+        ]
+        responses = self.post_concurrently(payloads)
+
+        assert sorted(response.status_code for response in responses) == [201, 201, 400]
+        assert User.query.count() == 2
+
+    def test_concurrent_project_creates_update_counter(self):
+        """Test that batched project inserts bump the owner's project count in the same transaction."""
+        user_id = self.client.post('/users', json={"name": "Owner", "email": "owner@example.com"}).json['id']
+        responses = [None] * 4
+
+        def post(index):
+            with self.app.test_client() as client:
+                responses[index] = client.post('/projects', json={"name": f"P{index}", "description": "Desc",
+                                                                  "user_id": user_id})
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert [response.status_code for response in responses] == [201] * 4
+        assert self.client.get('/users/stats').json['users'][0]['project_count'] == 4
+
+
+    def test_burst_larger_than_pool_completes(self, tmp_path):
+        """Test that more concurrent project creates than pooled connections do not starve the leader."""
+        file_app = create_app(testing=True, database_uri=f"sqlite:///{tmp_path / 'burst.db'}")
+        file_app.config['GROUP_COMMIT_WINDOW_MS'] = 50
+        with file_app.app_context():
+            db.create_all()
+            pool_capacity = db.engine.pool.size() + db.engine.pool._max_overflow
+        user_id = file_app.test_client().post('/users', json={"name": "Owner", "email": "owner@example.com"}).json['id']
+
+        requests = pool_capacity + 5
+        responses = [None] * requests
+
+        def post(index):
+            with file_app.test_client() as client:
+                responses[index] = client.post('/projects', json={"name": f"P{index}", "description": "Desc",
+                                                                  "user_id": user_id})
+
+        # Daemon threads with a bounded join, so a starved pool fails the test instead of hanging it
+        threads = [threading.Thread(target=post, args=(i,), daemon=True) for i in range(requests)]
+        deadline = time.monotonic() + 10
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+        assert not any(thread.is_alive() for thread in threads)
+        assert [response.status_code for response in responses] == [201] * requests
+        with file_app.app_context():
+            assert db.session.get(User, user_id).project_count == requests
+            db.session.remove()
+            db.engine.dispose()
+
+    def test_group_commit_project_for_missing_owner(self):
+        """Test that the in-batch owner check still reports an unknown user as 404."""
+        response = self.client.post('/projects', json={"name": "P", "description": "Desc", "user_id": 999})
+        assert response.status_code == 404
+        assert response.json == {'error': 'User not found'}
+
+
+class TestChangeFeedIntegrationTest:
+    @pytest.fixture(autouse=True)
+    def setup_and_teardown(self, client):
+        """Start every test with an empty outbox."""
+        self.client = client
+        User.query.delete()
+        Project.query.delete()
+        ChangeEvent.query.delete()
+        db.session.commit()
+        yield
+        User.query.delete()
+        Project.query.delete()
+        ChangeEvent.query.delete()
+        db.session.commit()
+
+    def test_write_routes_append_change_events(self):
+        """Test that each write route records its change in sequence order."""
+        user_id = self.client.post('/users', json={"name": "Alice", "email": "alice@example.com"}).json['id']
+        self.client.patch(f'/users/{user_id}', json={"name": "Alicia"})
+        project_id = self.client.post('/projects', json={"name": "P", "description": "D",
+                                                         "user_id": user_id}).json['project_id']
+        self.client.delete(f'/users/{user_id}')
+
+        response = self.client.get('/changes')
+        assert response.status_code == 200
+        events = response.json['events']
+        assert [(e['entity'], e['entity_id'], e['op']) for e in events] == [
+            ('user', user_id, 'created'),
+            ('user', user_id, 'updated'),
+            ('project', project_id, 'created'),
+            ('user', user_id, 'deleted'),
+            ('project', project_id, 'deleted'),
+        ]
+        assert events[1]['data'] == {'name': 'Alicia', 'version': 2}
+        assert [e['seq'] for e in events] == sorted(e['seq'] for e in events)
+        assert response.json['next'] == events[-1]['seq']
+
+    def test_changes_since_returns_only_newer_events(self):
+        """Test incremental sync from a previously seen sequence number."""
+        self.client.post('/users', json={"name": "Alice", "email": "alice@example.com"})
+        since = self.client.get('/changes').json['next']
+        self.client.post('/users', json={"name": "Bob", "email": "bob@example.com"})
+
+        events = self.client.get('/changes', query_string={'since': since}).json['events']
+        assert [e['data']['name'] for e in events] == ['Bob']
+        assert self.client.get('/changes', query_string={'since': events[-1]['seq']}).json['events'] == []
+
+    def test_changes_as_server_sent_events(self):
+        """Test that an event-stream client receives one SSE message per event."""
+        user_id = self.client.post('/users', json={"name": "Alice", "email": "alice@example.com"}).json['id']
+
+        response = self.client.get('/changes', query_string={'wait': 0}, headers={'Accept': 'text/event-stream'})
+        assert response.mimetype == 'text/event-stream'
+        body = response.get_data(as_text=True)
+        assert 'event: created\n' in body
+        assert f'"entity_id": {user_id}' in body
+
+    def test_changes_poll_is_a_single_query(self):
+        """Test that a poll serializes the rows it loaded instead of reloading each one."""
+        for i in range(5):
+            self.client.post('/users', json={"name": f"User {i}", "email": f"user{i}@example.com"})
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            events = self.client.get('/changes').json['events']
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        assert len(events) == 5
+        assert len(statements) == 1
+
+    def test_changes_limit_is_clamped(self):
+        """Test that out-of-range limits are clamped rather than bypassing the cap or spinning."""
+        for i in range(3):
+            self.client.post('/users', json={"name": f"User {i}", "email": f"user{i}@example.com"})
+
+        assert len(self.client.get('/changes', query_string={'limit': -1}).json['events']) == 1
+        assert len(self.client.get('/changes', query_string={'limit': 0}).json['events']) == 1
+
+    def test_compaction_keeps_only_recent_change_events(self):
+        """Test that compaction trims the outbox to the retention limit, oldest first."""
+        for i in range(5):
+            self.client.post('/users', json={"name": f"User {i}", "email": f"user{i}@example.com"})
+        seqs = [event['seq'] for event in self.client.get('/changes').json['events']]
+
+        assert compact(batch_size=2, keep_events=2)['change_events'] == 3
+        assert [event['seq'] for event in self.client.get('/changes').json['events']] == seqs[-2:]
+
+    def test_changes_rejects_bad_cursor(self):
+        """Test that a non-numeric cursor is a client error."""
+        response = self.client.get('/changes', query_string={'since': 'abc'})
+        assert response.status_code == 400
+
+
+class TestProfilingIntegrationTest:
+    @pytest.fixture(autouse=True)
+    def setup_and_teardown(self, app, client, tmp_path):
+        """Enable profiling into a temporary directory for each test."""
+        self.client = client
+        self.profile_dir = tmp_path
+        User.query.delete()
+        db.session.commit()
+        app.config.update(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0.0, PROFILING_SECRET='s3cret',
+                          PROFILING_DIR=str(tmp_path), PROFILING_MAX_PROFILES=200)
+        yield
+        app.config.update(PROFILING_ENABLED=False, PROFILING_SECRET=None, PROFILING_DIR='profiles')
+        User.query.delete()
+        db.session.commit()
+
+    def test_profile_header_writes_profile_and_spans(self):
+        """Test that a request asking for a profile gets cProfile stats and span timings."""
+        response = self.client.post('/users', json={"name": "Alice", "email": "alice@example.com"},
+                                    headers={'X-Profile': 's3cret'})
+        assert response.status_code == 201
+        profile_id = response.headers['X-Profile-Id']
+
+        assert (self.profile_dir / f'{profile_id}.prof').stat().st_size > 0
+        spans = dict(line.rsplit(' ', 1) for line in (self.profile_dir / f'{profile_id}.folded').read_text().splitlines())
+        assert set(spans) == {f'POST /users;{name}' for name in ('json_parse', 'db', 'serialize', 'other')}
+        assert all(int(value) >= 0 for value in spans.values())
+
+    def test_concurrent_profile_is_skipped(self):
+        """Test that a request arriving while another is profiled runs unprofiled instead of failing."""
+        with profiler_lock:
+            response = self.client.get('/users/list', headers={'X-Profile': 's3cret'})
+        assert response.status_code == 200
+        assert 'X-Profile-Id' not in response.headers
+        assert not profiler_lock.locked()
+
+    def test_failed_statements_do_not_inflate_db_span(self, app):
+        """Test that statements which raise are not charged to a later statement's DB span."""
+        with app.test_request_context('/users/list', headers={'X-Profile': 's3cret'}):
+            app.preprocess_request()
+            with db.engine.connect() as conn:
+                for _ in range(3):
+                    with pytest.raises(Exception):
+                        conn.execute(text('SELECT * FROM no_such_table'))
+                time.sleep(0.2)
+                conn.execute(text('SELECT 1'))
+            assert 0 < g.profile_spans['db'] < 0.1
+            app.process_response(app.make_response('ok'))
+
+    def test_db_listeners_detached_between_profiles(self, app):
+        """Test that the DB span listeners are only attached while a request is profiled."""
+        response = self.client.get('/users/list', headers={'X-Profile': 's3cret'})
+        assert 'X-Profile-Id' in response.headers
+        with app.app_context():
+            assert not event.contains(db.engine, 'before_cursor_execute', start_db_span)
+            assert not event.contains(db.engine, 'after_cursor_execute', end_db_span)
+        assert not profiler_lock.locked()
+
+    def test_wrong_secret_is_not_profiled(self):
+        """Test that the X-Profile header is ignored unless it carries the configured secret."""
+        response = self.client.get('/users/list', headers={'X-Profile': 'guess'})
+        assert 'X-Profile-Id' not in response.headers
+        self.client.application.config['PROFILING_SECRET'] = None
+        response = self.client.get('/users/list', headers={'X-Profile': ''})
+        assert 'X-Profile-Id' not in response.headers
+        assert list(self.profile_dir.iterdir()) == []
+
+    def test_profiling_stops_at_max_profiles(self):
+        """Test that no more profiles are written once PROFILING_DIR holds the maximum."""
+        self.client.application.config['PROFILING_MAX_PROFILES'] = 2
+        ids = [self.client.get('/users/list', headers={'X-Profile': 's3cret'}).headers.get('X-Profile-Id')
+               for _ in range(3)]
+        assert ids[0] and ids[1] and ids[2] is None
+        assert len(list(self.profile_dir.glob('*.prof'))) == 2
+
+    def test_unsampled_request_is_not_profiled(self):
+        """Test that requests without the header are skipped at a zero sample rate."""
+        response = self.client.get('/users/list')
+        assert 'X-Profile-Id' not in response.headers
+        assert list(self.profile_dir.iterdir()) == []
+
+    def test_sample_rate_profiles_without_header(self):
+        """Test that a full sample rate profiles every request."""
+        self.client.application.config['PROFILING_SAMPLE_RATE'] = 1.0
+        response = self.client.get('/users/list')
+        assert 'X-Profile-Id' in response.headers
@@ -54,6 +54,22 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(response.json, {'error': 'Database error occurred'})
 
+    @patch('app.models.db.session')
+    @patch('app.models.User')
+    def test_create_user_duplicate_email_postgresql(self, mock_user, mock_session):
+        # Mock the unique violation psycopg2 raises, which carries SQLSTATE 23505
+        mock_session.commit.side_effect = IntegrityError(
+            "duplicate key value violates unique constraint", None, MagicMock(pgcode='23505')
+        )
+
+        response = self.client.post(
+            '/users',
+            json={"name": "Jane Doe", "email": "jane@example.com"}
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {'message': 'User with this email already exists'})
+
     @patch('app.models.db.session')
     @patch('app.models.User')
     def test_create_user_internal_server_error(self, mock_user, mock_session):
@@ -69,6 +85,23 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(response.json, {'error': 'Internal Server Error'})
 
+    @patch('app.models.db.session')
+    def test_writes_take_outbox_lock_first_on_postgresql(self, mock_session):
+        # Pretend the session is bound to PostgreSQL so the advisory lock is emitted
+        mock_session.get_bind.return_value.dialect.name = 'postgresql'
+
+        for method, url, body in (
+            ('patch', '/users/1', {"name": "John"}),
+            ('delete', '/users/1', None),
+            ('delete', '/projects/1', None),
+        ):
+            mock_session.execute.reset_mock()
+            getattr(self.client, method)(url, json=body)
+
+            # The first statement of the transaction must be the lock, before any row lock
+            first_statement = str(mock_session.execute.call_args_list[0].args[0])
+            self.assertIn('pg_advisory_xact_lock', first_statement)
+
     @patch('app.models.User.query')  # Patch the User query to mock data
     def test_get_users_success(self, mock_user_query):
         # Create mock user objects with mocked attributes
@@ -1,6 +1,8 @@
 import pytest
 from app.models import User
-from app import db
+from app import create_app, db
+from app.schema import backfill_project_counts, upgrade_schema
+from sqlalchemy import inspect, select, text
 from sqlalchemy.exc import IntegrityError
 import re
 
@@ -84,3 +86,42 @@ class TestUserModel:
             with pytest.raises(IntegrityError):
                 add_user(name="No Email", email='')
 
+
+class TestSchemaUpgrade:
+
+    def test_upgrade_schema_and_backfill_project_counts(self, tmp_path):
+        """Test upgrading a database created before versions, soft deletes and counters existed."""
+        legacy_app = create_app(testing=True, database_uri=f"sqlite:///{tmp_path / 'legacy.db'}")
+        with legacy_app.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, email VARCHAR(120) NOT NULL)"))
+                conn.execute(text("CREATE TABLE projects (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, "
+                                  "description VARCHAR, user_id INTEGER NOT NULL REFERENCES users (id))"))
+                conn.execute(text("INSERT INTO users (id, name, email) VALUES (1, 'Alice', 'a@example.com'), "
+                                  "(2, 'Bob', 'b@example.com')"))
+                conn.execute(text("INSERT INTO projects (name, user_id) VALUES ('One', 1), ('Two', 1)"))
+
+            changes = upgrade_schema()
+            assert 'added users.project_count' in changes
+            assert 'added projects.deleted_at' in changes
+            assert backfill_project_counts() == 2
+
+            counts = db.session.execute(select(User.id, User.project_count, User.version).order_by(User.id)).all()
+            assert [tuple(row) for row in counts] == [(1, 2, 1), (2, 0, 1)]
+            assert 'change_events' in inspect(db.engine).get_table_names()
+            assert upgrade_schema() == []
+            db.session.remove()
+            db.engine.dispose()
+
+    def test_upgrade_schema_reports_sqlite_email_constraint(self, tmp_path):
+        """Test that an inline UNIQUE(email) SQLite cannot drop is reported rather than silently kept."""
+        legacy_app = create_app(testing=True, database_uri=f"sqlite:///{tmp_path / 'legacy.db'}")
+        with legacy_app.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, "
+                                  "email VARCHAR(120) NOT NULL UNIQUE)"))
+
+            changes = upgrade_schema()
+            assert any(change.startswith('kept UNIQUE(email) on users') for change in changes)
+            db.session.remove()
+            db.engine.dispose()